@@ -7,4 +7,4 @@ setup(name='Simple Scraper',
       author='fbcsec',
       author_email='fbc@disroot.org',
       scripts=['simple_scraper.py'],
-      install_requires=['bs4'])
+      install_requires=['lxml>=4.9.3', 'urllib3>=1.26.18'])
@@ -1,19 +1,38 @@
 #!/usr/bin/env python3
 """
-Simple HREF scraper. Uses Beautiful Soup to pull all of the hrefs from a
+Simple HREF scraper. Uses lxml's streaming parser to pull all of the hrefs from a
 document. The URLs are then filtered based on a simple comma-separated
-list of file extensions. Finally urllib is used to get and write the files
-to a specified directory. See this_script.py -h for options.
+list of file extensions. Finally urllib3 is used to get and write the files
+to a specified directory. See simple_scraper.py -h for options.
 """
 
 import argparse
-from collections import OrderedDict
-import datetime
-import hashlib
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+import logging
+import logging.handlers
+import queue
+import re
+import shutil
+import sys
 from time import sleep
-from urllib.request import Request, urlopen, urlretrieve
+from urllib.parse import urldefrag, urljoin, urlsplit
 import os
-from bs4 import BeautifulSoup
+import stat
+import tempfile
+import lxml.etree
+import urllib3
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; WOW64; rv:56.0) Gecko/20100101 Firefox/56.0'
+# Downloads are copied to disk in chunks of this size, so each download thread
+# holds at most this much of a file in memory regardless of the file's size.
+CHUNK_SIZE = 1 << 20
+
+log = logging.getLogger('simple_scraper')
+
+# Matches a <meta charset=...> or http-equiv Content-Type declaration near the start of a page.
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset\s*=', re.IGNORECASE)
 
 
 def argparse_factory():
@@ -33,188 +52,379 @@ def argparse_factory():
     parser.add_argument('-w', '--wait-time', help="Amount of time to wait between downloads."
                                                   " Increasing this can help with target servers that are rate limited"
                                                   " and with ensuring that the modification date on output files"
-                                                  " are correct. Default is 1, set to 0 to not wait.",
-                        nargs='?',
-                        default='1')
+                                                  " are correct. Each download thread waits after its own"
+                                                  " downloads. Default is 1, set to 0 to not wait.",
+                        type=int, default=1)
+    parser.add_argument('-c', '--concurrency', help="Number of files to download at once. Default is 8.",
+                        type=int, default=8)
     parser.add_argument("-s", "--skip-exists", help="Skip downloading files that already exist in the destination"
                                                     "directory", action="store_true")
-    return parser.parse_args()
+    args = parser.parse_args()
+    # Compile the extension list once here so find_hotlinks does a single regex match per link.
+    # None means grab everything.
+    if args.file_types is None or args.file_types == '*':
+        args.ext_re = None
+    else:
+        exts = [ext for ext in args.file_types.split(',') if ext]
+        if not exts:
+            parser.error("argument -f/--file-types: expected at least one file extension, or '*'")
+        args.ext_re = compile_ext_re(exts)
+    return args
+
+
+def compile_ext_re(exts):
+    """Compile a case insensitive regex matching URLs whose path ends in one of the (non-empty) extensions in exts.
+    Any query string or fragment after the path is ignored."""
+    alternatives = '|'.join(re.escape(ext) for ext in exts)
+    return re.compile(r'[^?#]*\.(?:%s)(?:[?#]|$)' % alternatives, re.IGNORECASE)
+
+
+def setup_logging(debug=False, quiet=False):
+    """Send log records through a queue to a single listener thread that writes them to stdout,
+    so download threads never block on the console. Quiet mode disables logging entirely.
+    Returns the started QueueListener."""
+    log_queue = queue.Queue()
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(logging.DEBUG if debug else logging.INFO)
+    log.propagate = False
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, stdout_handler)
+    listener.start()
+    if quiet:
+        logging.disable(logging.CRITICAL)
+    return listener
 
 
 def check_if_valid_path(path, debug=False):
     """Check if destination path is valid by attempting to open a file in it. Returns true or forces an exit."""
-    filename = str(str(hashlib.md5(str(datetime.datetime.now()).encode('utf-8')).hexdigest()[0:10]))
     if debug:
-        print("Checking if path is valid by touching %s" % path + '/' + filename)
+        log.debug("Checking if path is valid by creating a temporary file in %s", path)
     try:
-        with open(path + '/' + filename, 'x'):
+        # The test file is removed when it's closed.
+        with tempfile.NamedTemporaryFile(dir=path, prefix='.write_test_') as test_file:
             if debug:
-                print("Successfully opened test file.")
-                print("Deleting test file...")
-        os.unlink(path + '/' + filename)
+                log.debug("Successfully opened test file %s.", test_file.name)
+                log.debug("Deleting test file...")
         return True
     except BaseException as ex:
         if debug:
-            print(ex)
+            log.debug(ex)
         raise SystemExit('Error, could not write to destination directory %s' % path)
 
 
-def get_target_html(url, debug=False):
-    """Obtain the raw html of the page we want to scrape. Returns the html or forces an exit."""
+def open_dir_fd(path):
+    """Open path as a directory file descriptor so output files can be opened relative to it
+    without walking the full path each time. Returns None on platforms without dir_fd support."""
+    if os.open in os.supports_dir_fd and hasattr(os, 'O_DIRECTORY'):
+        return os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    return None
+
+
+def get_target_html(http, url, debug=False):
+    """Obtain the raw html of the page we want to scrape using the urllib3 pool http.
+    Returns a tuple of the html and its encoding (see guess_encoding()) or forces an exit."""
     try:
         if debug:
-            print("Attempting to fetch %s" % url)
-        req = Request(url, headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; WOW64; rv:56.0) Gecko/20100101 '
-                                                  'Firefox/56.0'})
-        with urlopen(req) as response:
-            if debug:
-                print(str(response.info()))
-            html = response.read()
-            return html
+            log.debug("Attempting to fetch %s", url)
+        response = http.request('GET', url)
+        if debug:
+            log.debug('%s', response.headers)
+        if response.status >= 400:
+            raise urllib3.exceptions.HTTPError("HTTP status %d" % response.status)
+        html = response.data
+        return html, guess_encoding(response.headers.get('Content-Type', ''), html)
     except BaseException as ex:
         if debug:
-            print(ex)
+            log.debug(ex)
         raise SystemExit("Error, could not connect to target %s" % url)
 
 
-def find_hotlinks(html, exts='*', debug=False):
-    """Build a list of all the href targets in an html document. Then filters the list """
-    hotlinks = list()
+def guess_encoding(content_type, html):
+    """Pick the encoding to parse html with. Uses the charset from the Content-Type header
+    content_type if there is a valid one. Returns None when the page declares its own charset
+    in a meta tag, so lxml honours it, and falls back to utf-8 otherwise."""
+    for param in content_type.split(';')[1:]:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'charset':
+            charset = value.strip().strip('"\'')
+            # Python's codec name can differ from what libxml2 accepts (euc_jp vs EUC-JP),
+            # so only validate the charset here and hand lxml the header's own spelling.
+            try:
+                codecs.lookup(charset)
+            except LookupError:
+                break
+            return charset
+    if META_CHARSET_RE.search(html[:1024]):
+        return None
+    return 'utf-8'
+
+
+class HrefCollector:
+    """lxml parser target that keeps the href of each start tag instead of building a tree."""
+
+    def __init__(self):
+        self.hrefs = list()
+
+    def start(self, tag, attrib):
+        href = attrib.get('href')
+        # Keep href="" like find_all(href=True) and //@href did.
+        if href is not None:
+            self.hrefs.append(href)
+
+    def end(self, tag):
+        pass
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return self.hrefs
+
+
+def find_hotlinks(html, ext_re=None, encoding=None, debug=False):
+    """Build a list of all the href targets in an html document decoded with encoding.
+    Then filters the list to links matched by ext_re (see compile_ext_re()), or returns
+    every link if ext_re is None. Duplicates are removed later, once the links are resolved
+    by check_and_fix_protocol()."""
     filtered_list = list()
 
-    soup = BeautifulSoup(html, 'html.parser')
+    if debug and ext_re is not None:
+        log.debug('Passed good extensions: ')
+        log.debug(ext_re.pattern)
+
     if debug:
-        print('Finding hrefs.')
-    for link in soup.find_all(href=True):
-        hotlinks.append(link['href'])
-    deduped_hotlinks = list(OrderedDict.fromkeys(hotlinks))
-    if exts is not '*':
-        exts = exts.split(',')
+        log.debug('Finding hrefs.')
+    # The parser feeds tags to HrefCollector as it goes, so no document tree is kept in memory.
+    try:
+        parser = lxml.etree.HTMLParser(target=HrefCollector(), encoding=encoding)
+    except LookupError:
+        # libxml2 doesn't know this charset, let it detect the encoding itself.
         if debug:
-            print('Passed good extensions: ')
-            print(exts)
-        for link in deduped_hotlinks:
-            link_ext = link.split(".")[-1::][0]
-            if debug:
-                print('Checking ' + link)
-                print('Split: ')
-                print(link_ext)
-            if link_ext in exts:
-                filtered_list.append(link)
-    else:
-        filtered_list = deduped_hotlinks
+            log.debug('lxml does not support encoding %s, ignoring it.', encoding)
+        parser = lxml.etree.HTMLParser(target=HrefCollector())
+    for link in lxml.etree.fromstring(html, parser):
+        if ext_re is None:
+            filtered_list.append(link)
+            continue
+        if debug:
+            log.debug('Checking %s', link)
+        if ext_re.match(link):
+            filtered_list.append(link)
 
     if debug:
         for link in filtered_list:
-            print("\t%s" % link)
+            log.debug("\t%s", link)
 
     return filtered_list
 
 
 def check_and_fix_protocol(original_target, urls, debug=False):
-    """Read a list of URLs and ensure they have a protocol associated with them.
-    If the protocol is missing, match the protocol to a target URL.
-    Return a new list containing the verified URLs."""
+    """Read a list of URLs and resolve each one against the target URL, filling in a missing
+    protocol and/or host for protocol-relative ('//host/file') and relative links.
+    Return a new list containing the absolute URLs with fragments dropped and duplicates removed,
+    so spellings like 'img.jpg', './img.jpg' and 'img.jpg#x' are only fetched once."""
     fixed_urllist = list()
-    protocol = original_target.split(':')[0]
+    seen = set()
     for link in urls:
-        if ":" in link:
-            if debug:
-                print("Link has protocol information: %s" % link)
-            fixed_urllist.append(link)
-        else:
-            if debug:
-                print("Link missing protocol information.")
-            # Assume a url prefixed by '//' (missing protocol) should be
-            # accessed with the same protocol as the original url.
-            protocol_added = protocol + ":" + link
-            fixed_urllist.append(protocol_added)
-            if debug:
-                print("New link: %s" % protocol_added)
+        # The fragment is never sent to the server, it doesn't make a different file.
+        fixed_link = urldefrag(urljoin(original_target, link))[0]
+        if debug and link != fixed_link:
+            log.debug("Resolved %s to %s", link, fixed_link)
+        if fixed_link not in seen:
+            seen.add(fixed_link)
+            fixed_urllist.append(fixed_link)
     return fixed_urllist
 
 
-def download_file(url, destination_dir, debug=False, silent=False,
+def url_filename(url):
+    """Return the name url is saved under, its last path segment without any query string or fragment."""
+    return os.path.basename(urlsplit(url).path)
+
+
+def download_file(http, url, destination_dir, debug=False, silent=False,
                   halt_on_error=False, dry_run=False, wait_time=0,
-                  skip_exists=False):
+                  skip_exists=False, progress=None, dir_fd=None):
     """Download file and write to destination_dir while handling errors.
-    Practically a frontend to urllib.request.urlretrieve()."""
-    filename = url.split("/")[-1]
-    full_path = destination_dir + "/" + filename
+    Requests go through the urllib3 pool http so connections to the same host are reused.
+    If dir_fd is an open descriptor for destination_dir files are opened relative to it.
+    Safe to call from multiple threads."""
+    filename = url_filename(url)
+    full_path = os.path.join(destination_dir, filename)
+    if dir_fd is None:
+        target, opener = full_path, None
+    else:
+        target = filename
+
+        def opener(path, flags):
+            return os.open(path, flags, 0o666, dir_fd=dir_fd)
     if not silent:
-        print("[+] Downloading %s to %s..." % (url, full_path))
+        # One record so the progress line stays next to its download in threaded output.
+        log.info("%s[+] Downloading %s to %s...", progress + "\n" if progress else "", url, full_path)
     try:
         if not dry_run:
-            if skip_exists:
-                if not os.path.isfile(full_path):
-                    res = urlretrieve(url, full_path)
-                    sleep(wait_time)
-                    if debug:
-                        print(res)
-                else:
-                    if not silent:
-                        print('[!] %s exists, skipping!' % filename)
+            if skip_exists and is_file(target, dir_fd):
+                if not silent:
+                    log.info('[!] %s exists, skipping!', filename)
+            elif is_unchanged(http, url, target, dir_fd=dir_fd, debug=debug):
+                if not silent:
+                    log.info('[!] %s is unchanged on the server, skipping!', filename)
             else:
-                res = urlretrieve(url, full_path)
+                response = http.request('GET', url, preload_content=False)
+                try:
+                    if debug:
+                        log.debug('%s', response.headers)
+                    if response.status >= 400:
+                        # Read the short error body so the connection can be reused.
+                        response.read()
+                        raise urllib3.exceptions.HTTPError("HTTP status %d" % response.status)
+                    try:
+                        with open(target, 'wb', opener=opener) as output_file:
+                            shutil.copyfileobj(response, output_file, length=CHUNK_SIZE)
+                    except BaseException:
+                        # The rest of the body is still unread, so the connection can't be reused.
+                        response.close()
+                        raise
+                finally:
+                    # Always hand the connection back, the pool has a fixed number of slots per host.
+                    response.release_conn()
                 sleep(wait_time)
-                if debug:
-                    print(res)
         else:
             if not silent:
-                print("[!] Dry Run, no file saved!")
+                log.info("[!] Dry Run, no file saved!")
         if not silent:
-            print("[+] Done.\n")
+            log.info("[+] Done: %s\n", filename)
         return True
     except BaseException as ex:
         if debug:
-            print(ex)
+            log.debug(ex)
         if halt_on_error:
-            raise SystemExit("Download failed and halt on error set, halting." % url)
+            raise SystemExit("Download of %s failed and halt on error set, halting." % url)
         else:
             if not silent:
-                print("[-] Download Failed" % url)
+                log.info("[-] Download of %s failed", url)
             return False
 
 
-def main():
-    args = argparse_factory()
+def download_files(http, jobs, destination_dir, **kwargs):
+    """Call download_file() for each (url, progress) pair in jobs, one after another.
+    scrape() groups urls that are saved under the same filename into one call, so two threads
+    never write the same file at once and the last url wins like a serial run.
+    Returns a list of download_file() results."""
+    return [download_file(http, url, destination_dir, progress=progress, **kwargs)
+            for url, progress in jobs]
+
+
+def is_file(path, dir_fd=None):
+    """os.path.isfile() that also accepts a path relative to dir_fd."""
+    try:
+        return stat.S_ISREG(os.stat(path, dir_fd=dir_fd).st_mode)
+    except (OSError, ValueError):
+        return False
+
+
+def is_unchanged(http, url, path, dir_fd=None, debug=False):
+    """Check whether an existing local copy of url at path (relative to dir_fd if given) matches
+    the server's file. Sends a HEAD request and treats a matching Content-Length with no newer
+    Last-Modified as unchanged. The size check is also what catches a truncated copy left by an
+    interrupted download. Returns False if there's no local copy or the server can't tell us."""
+    try:
+        local = os.stat(path, dir_fd=dir_fd)
+    except (OSError, ValueError):
+        return False
+    if not stat.S_ISREG(local.st_mode):
+        return False
+    try:
+        head = http.request('HEAD', url)
+    except urllib3.exceptions.HTTPError as ex:
+        if debug:
+            log.debug(ex)
+        return False
+    if head.status >= 400:
+        return False
+    last_modified = head.headers.get('Last-Modified')
+    if last_modified:
+        try:
+            if parsedate_to_datetime(last_modified).timestamp() > local.st_mtime:
+                return False
+        except (TypeError, ValueError):
+            pass
+    content_length = head.headers.get('Content-Length')
+    return content_length is not None and content_length.isdigit() and int(content_length) == local.st_size
+
+
+def scrape(args):
+    """Scrape and download everything described by the parsed arguments args."""
     TARGET_URL = args.target_url
     OUTPUT_DIR = args.destination_directory
     DEBUG_MODE = args.debug
-    EXT_LIST = args.file_types
+    EXT_RE = args.ext_re
     QUIET = args.quiet
     HALT_NONFATAL = args.halt_error
     DRY_RUN = args.dry_run
-    WAIT_TIME = int(args.wait_time)
+    WAIT_TIME = args.wait_time
     SKIP_EXISTS= args.skip_exists
+    CONCURRENCY = max(1, args.concurrency)
 
     if DEBUG_MODE:
-        print('[!] DEBUG mode on.')
-        print('Arguments object:')
-        print("\t" + str(args))
+        log.debug('[!] DEBUG mode on.')
+        log.debug('Arguments object:')
+        log.debug("\t%s", args)
 
     if not QUIET:
-        print('[+] Scraping %s' % TARGET_URL)
-        print('[+] Saving to %s' % OUTPUT_DIR)
+        log.info('[+] Scraping %s', TARGET_URL)
+        log.info('[+] Saving to %s', OUTPUT_DIR)
 
     check_if_valid_path(OUTPUT_DIR, debug=DEBUG_MODE)
-    html = get_target_html(TARGET_URL, debug=DEBUG_MODE)
-    found_hotlinks = find_hotlinks(html, exts=EXT_LIST, debug=DEBUG_MODE)
+    OUTPUT_DIR_FD = open_dir_fd(OUTPUT_DIR)
+    # One pooled connection per download thread, block=True caps each host at CONCURRENCY connections.
+    # Every request must give its connection back (download_file releases in a finally), otherwise
+    # a blocking pool runs out of slots and the remaining downloads wait forever.
+    http = urllib3.PoolManager(maxsize=CONCURRENCY, block=True, headers={'User-Agent': USER_AGENT})
+    html, encoding = get_target_html(http, TARGET_URL, debug=DEBUG_MODE)
+    found_hotlinks = find_hotlinks(html, ext_re=EXT_RE, encoding=encoding, debug=DEBUG_MODE)
     links_to_download = check_and_fix_protocol(TARGET_URL, found_hotlinks, debug=DEBUG_MODE)
     total_links = len(links_to_download)
     if not QUIET:
-        print('[+] Found %d hotlinks.' % total_links)
+        log.info('[+] Found %d hotlinks.', total_links)
         for link in links_to_download:
-            print("\t%s" % link)
-        print("\n")
+            log.info("\t%s", link)
+        log.info("\n")
 
+    # Links that share a filename go to the same worker, in page order, so they aren't written concurrently.
+    jobs_by_filename = dict()
     for index, link in enumerate(links_to_download):
-        if not QUIET:
-            print("[+] [%d / %d]" % (int(index+1), total_links))
-        download_file(link, OUTPUT_DIR, debug=DEBUG_MODE,
-                      silent=QUIET, halt_on_error=HALT_NONFATAL,
-                      dry_run=DRY_RUN, wait_time=WAIT_TIME,
-                      skip_exists=SKIP_EXISTS)
+        jobs_by_filename.setdefault(url_filename(link), list()).append(
+            (link, "[+] [%d / %d]" % (int(index+1), total_links)))
+
+    try:
+        with ThreadPoolExecutor(max_workers=CONCURRENCY) as pool:
+            futures = [pool.submit(download_files, http, jobs, OUTPUT_DIR, debug=DEBUG_MODE,
+                                   silent=QUIET, halt_on_error=HALT_NONFATAL,
+                                   dry_run=DRY_RUN, wait_time=WAIT_TIME,
+                                   skip_exists=SKIP_EXISTS, dir_fd=OUTPUT_DIR_FD)
+                       for jobs in jobs_by_filename.values()]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Halt on error was hit in a worker or the user hit Ctrl-C, don't start any queued downloads.
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        if OUTPUT_DIR_FD is not None:
+            os.close(OUTPUT_DIR_FD)
+
+
+def main():
+    args = argparse_factory()
+    listener = setup_logging(debug=args.debug, quiet=args.quiet)
+    try:
+        scrape(args)
+    finally:
+        # Flush queued records before any SystemExit message is printed.
+        listener.stop()
 
 
 if __name__ == "__main__":